@@ -13,29 +13,44 @@ Extracts:
 
 Usage:
     python scripts/bama_scraper.py
+    python scripts/bama_scraper.py --cache   # reuse cached API responses during development
+    python scripts/bama_scraper.py --format parquet   # or csv; default is xlsx
 """
 
 import os
 import re
+import csv
+import math
 import time
-import random
+import hashlib
 import argparse
+import threading
 from pathlib import Path
-from typing import List, Optional, Dict, Any
-from dataclasses import dataclass, asdict
+from typing import List, Optional, Dict, Any, Set, Tuple
+from dataclasses import dataclass, asdict, astuple, fields
+from functools import lru_cache
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
 
+import orjson
 import requests
 import xlsxwriter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
 API_URL = "https://bama.ir/cad/api/search"
 OUTPUT_PATH = Path("data/samand_listings.xlsx")
 MIN_YEAR = 1385
 TARGET_COUNT = 50
+PAGE_WINDOW = 8  # Pages kept in flight at once
+REQUESTS_PER_SECOND = 2  # Shared rate cap across all in-flight fetches
+CACHE_NAME = "bama_cache"  # SQLite file used by --cache
 
 # Headers for API requests (from curl command)
 API_HEADERS = {
     'accept': 'application/json, text/plain, */*',
+    'accept-encoding': 'gzip, deflate',
     'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8,fa;q=0.7',
     'priority': 'u=1, i',
     'referer': 'https://bama.ir/car/samand',
@@ -57,8 +72,15 @@ COOKIES = {
 }
 
 PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹", "0123456789")
+# Persian digits -> ASCII with separators and whitespace removed in one pass
+_PRICE_TABLE = str.maketrans("۰۱۲۳۴۵۶۷۸۹", "0123456789", ",،٬ ")
+_MILEAGE_TABLE = str.maketrans("۰۱۲۳۴۵۶۷۸۹", "0123456789", ",،٬ \t\n")
+# Units are removed as whole words so values like 'صفر' (zero km) stay intact
+_MILEAGE_UNIT_RE = re.compile(r"\s*(?:km|کیلومتر)\b", re.IGNORECASE)
+# One scan for either transmission keyword; the matching group name gives the type
+_TRANSMISSION_RE = re.compile(r"(?P<manual>دنده|manual)|(?P<automatic>اتومات|automatic)", re.IGNORECASE)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class CarListing:
     price: Optional[str]
     mileage: Optional[str]
@@ -79,32 +101,24 @@ def parse_year(year_str: str) -> Optional[int]:
     if not year_str:
         return None
     normalized = normalize_text(year_str)
-    try:
-        year = int(normalized)
-        if MIN_YEAR < year < 1500:  # Valid Persian year range
-            return year
-    except ValueError:
-        pass
-    return None
+    # isdecimal() (unlike isdigit()) guarantees int() succeeds, so no try/except is needed
+    if not normalized.isdecimal():
+        return None
+    year = int(normalized)
+    return year if MIN_YEAR < year < 1500 else None  # Valid Persian year range
 
+@lru_cache(maxsize=2048)
 def extract_transmission(transmission_str: str) -> str:
-    """Extract transmission type from Persian text."""
-    if not transmission_str:
+    """Extract transmission type from Persian text (cached; values repeat across ads)."""
+    m = _TRANSMISSION_RE.search(transmission_str or "")
+    if not m:
         return "Unknown"
-    t = transmission_str.lower()
-    if "دنده" in t or "manual" in t:
-        return "Manual"
-    if "اتومات" in t or "automatic" in t:
-        return "Automatic"
-    return "Unknown"
+    return "Manual" if m.lastgroup == "manual" else "Automatic"
 
 def parse_mileage(mileage_str: str) -> str:
     """Extract mileage number from string like '66,000 km'."""
-    if not mileage_str:
-        return "0"
-    # Remove 'km' and commas, keep only digits
-    normalized = normalize_text(mileage_str.replace("km", "").replace("کیلومتر", ""))
-    return normalized if normalized else "0"
+    # Remove 'km'/'کیلومتر' and commas, keep only digits
+    return _MILEAGE_UNIT_RE.sub("", mileage_str or "").translate(_MILEAGE_TABLE) or "0"
 
 def parse_price(price_data: Dict) -> str:
     """Extract price from price object."""
@@ -113,7 +127,7 @@ def parse_price(price_data: Dict) -> str:
     price_str = price_data.get("price", "")
     if price_str:
         # Remove commas
-        return price_str.replace(",", "")
+        return price_str.translate(_PRICE_TABLE)
     return "Agreement"
 
 def parse_api_listing(ad_data: Dict) -> Optional[CarListing]:
@@ -140,17 +154,14 @@ def parse_api_listing(ad_data: Dict) -> Optional[CarListing]:
     transmission_str = detail.get("transmission", "")
     transmission = extract_transmission(transmission_str)
     
-    # Extract color
-    color = detail.get("color", "") or detail.get("body_color", "") or "Unknown"
-    if not color or color == "":
-        color = "Unknown"
+    # Extract color (first non-empty candidate)
+    color = next((v for v in (detail.get("color"), detail.get("body_color")) if v), "Unknown")
     
-    # Extract description
-    description = detail.get("description", "") or detail.get("title", "") or ""
-    if not description:
-        subtitle = detail.get("subtitle", "")
-        title = detail.get("title", "")
-        description = f"{title} - {subtitle}".strip()
+    # Extract description, falling back to title, then subtitle
+    description = next(
+        (v for v in (detail.get("description"), detail.get("title"), detail.get("subtitle")) if v),
+        ""
+    )
     
     # Extract URL
     url_path = detail.get("url", "")
@@ -166,86 +177,231 @@ def parse_api_listing(ad_data: Dict) -> Optional[CarListing]:
         url=url
     )
 
-def scrape_bama(limit: int = 50):
-    """Scrape Samand cars from bama.ir using API endpoint."""
+class RateLimiter:
+    """Thread-safe token bucket: allows max_rate requests per time_period across threads."""
+
+    def __init__(self, max_rate: float, time_period: float = 1.0):
+        self.capacity = max_rate
+        self.tokens = max_rate
+        self.fill_rate = max_rate / time_period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, stop: Optional[threading.Event] = None) -> bool:
+        """
+        Block until a request token is available; return False if stop is set first.
+
+        Tokens are reserved at call time, so waiting callers are served in the order they arrived.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.fill_rate if self.tokens < 0 else 0.0
+        if stop is None:
+            time.sleep(wait)
+            return True
+        if stop.wait(wait):
+            with self.lock:
+                self.tokens += 1  # Hand the unused reservation back
+            return False
+        return True
+
+def content_signature(ad_data: Dict, car: CarListing) -> Optional[bytes]:
+    """
+    Digest of an ad's own full description plus its parsed fields, so an ad reposted
+    under a new URL still matches. Returns None when the ad has no description of its
+    own: title/subtitle fallbacks are shared by many distinct listings.
+    """
+    description = ad_data.get("detail", {}).get("description")
+    if not description:
+        return None
+    key = f"{description}|{car.mileage}|{car.price}|{car.production_year}|{car.color}|{car.transmission}"
+    return hashlib.blake2b(key.encode(), digest_size=8).digest()
+
+def fetch_page(session: requests.Session, limiter: RateLimiter, page_index: int,
+               stop: threading.Event) -> Optional[Dict[str, Any]]:
+    """Fetch one page of search results and return the decoded JSON (None if stopped)."""
+    if stop.is_set():
+        return None
+    params = {
+        "vehicle": "samand",
+        "pageIndex": page_index
+    }
+    resp = None
+    if hasattr(session, "cache"):
+        # --cache: hits never reach bama.ir, so answer them without waiting for a rate-limit token
+        resp = session.get(API_URL, params=params, timeout=30, only_if_cached=True)
+        if resp.status_code == 504:  # requests-cache's "not cached" response
+            resp = None
+    if resp is None:
+        # Be respectful with API; pages still waiting for a token when the scrape ends are skipped
+        if not limiter.acquire(stop) or stop.is_set():
+            return None
+        resp = session.get(API_URL, params=params, timeout=30)
+    resp.raise_for_status()
+    # Persian digits are normalized per numeric field, so free text is exported as-is
+    return orjson.loads(resp.content)
+
+def fetch_and_parse_page(session: requests.Session, limiter: RateLimiter, page_index: int,
+                         stop: threading.Event) -> Optional[Tuple[Dict[str, Any], List[Tuple[CarListing, Optional[bytes]]]]]:
+    """
+    Fetch one page and parse its ads on the worker thread, overlapping other downloads.
+    Each parsed car is paired with its content signature (see content_signature).
+    """
+    data = fetch_page(session, limiter, page_index, stop)
+    if data is None:
+        return None
+    ads_data = data.get("data", {}).get("ads", [])
+    cars = []
+    for ad in ads_data:
+        car = parse_api_listing(ad)
+        if car:
+            cars.append((car, content_signature(ad, car)))
+    return data, cars
+
+def create_session(use_cache: bool = False) -> requests.Session:
+    """Create the API session: headers, cookies, pooled keep-alive adapter, optional cache."""
+    if use_cache:
+        # Development re-runs: identical GETs are answered from a local SQLite cache
+        import requests_cache
+        session = requests_cache.CachedSession(
+            CACHE_NAME,
+            backend="sqlite",
+            expire_after=600,
+            allowable_codes=(200,)
+        )
+    else:
+        session = requests.Session()
+    session.headers.update(API_HEADERS)
+    session.headers["connection"] = "keep-alive"
+    session.cookies.update(COOKIES)
+    # Pool enough connections for every in-flight page and retry transient failures
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"]
+        )
+    )
+    session.mount("https://", adapter)
+    return session
+
+def scrape_bama(
+    limit: int = 50,
+    use_cache: bool = False,
+    session: Optional[requests.Session] = None,
+    executor: Optional[ThreadPoolExecutor] = None
+) -> List[CarListing]:
+    """
+    Scrape Samand cars from bama.ir using API endpoint.
+
+    Pass a session/executor to reuse pooled connections and worker threads across
+    several calls; anything not passed in is created here and closed on return.
+    """
     collected_cars: List[CarListing] = []
+    seen_urls: Set[str] = set()
+    seen_signatures: Set[bytes] = set()
     page_index = 1
     
-    session = requests.Session()
-    session.headers.update(API_HEADERS)
-    session.cookies.update(COOKIES)
+    limiter = RateLimiter(REQUESTS_PER_SECOND)
+    stop = threading.Event()  # Set once we have enough cars, so queued fetches skip their GET
 
     print(f"Starting scrape for {limit} Samand cars (Year > {MIN_YEAR})...")
 
-    while len(collected_cars) < limit:
-        print(f"Fetching page {page_index}... (Collected: {len(collected_cars)}/{limit})")
+    with ExitStack() as stack:
+        if session is None:
+            session = stack.enter_context(create_session(use_cache))
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=PAGE_WINDOW))
+
+        pending: Dict[int, Future] = {}
+        next_page = 1
+        last_page = 1  # Only page 1 is known to exist until its metadata arrives
+        lookahead = PAGE_WINDOW
+
         try:
-            # Use API endpoint with pageIndex parameter
-            params = {
-                "vehicle": "samand",
-                "pageIndex": page_index
-            }
-            resp = session.get(API_URL, params=params, timeout=30)
-            
-            if resp.status_code != 200:
-                print(f"Error fetching page {page_index}: {resp.status_code}")
-                break
-            
-            # Parse JSON response
-            data = resp.json()
-            
-            if not data.get("status", False):
-                print(f"API returned error: {data.get('errors', [])}")
-                break
-            
-            # Get metadata
-            metadata = data.get("metadata", {})
-            total_pages = metadata.get("total_pages", 0)
-            total_count = metadata.get("total_count", 0)
-            
-            print(f"  Total listings: {total_count}, Total pages: {total_pages}")
-            
-            # Get ads from response
-            ads_data = data.get("data", {}).get("ads", [])
-            
-            if not ads_data:
-                print("No listings found on this page. Ending scrape.")
-                break
-
-            print(f"  Found {len(ads_data)} listings on page {page_index}")
-
-            page_new_count = 0
-            for ad in ads_data:
-                car = parse_api_listing(ad)
-                if car:
-                    # Avoid duplicates (check by URL)
-                    if not any(c.url == car.url for c in collected_cars):
+            while len(collected_cars) < limit:
+                # Keep up to PAGE_WINDOW pages in flight; a slow page only delays its own slot
+                while next_page < page_index + lookahead and next_page <= last_page:
+                    pending[next_page] = executor.submit(fetch_and_parse_page, session, limiter, next_page, stop)
+                    next_page += 1
+
+                print(f"Fetching page {page_index}... (Collected: {len(collected_cars)}/{limit})")
+                try:
+                    data, page_cars = pending.pop(page_index).result()
+                
+                    if not data.get("status", False):
+                        print(f"API returned error: {data.get('errors', [])}")
+                        break
+                
+                    # Get metadata
+                    metadata = data.get("metadata", {})
+                    total_pages = metadata.get("total_pages", 0)
+                    total_count = metadata.get("total_count", 0)
+                    last_page = total_pages
+                
+                    print(f"  Total listings: {total_count}, Total pages: {total_pages}")
+                
+                    # Get ads from response
+                    ads_data = data.get("data", {}).get("ads", [])
+                
+                    if not ads_data:
+                        print("No listings found on this page. Ending scrape.")
+                        break
+
+                    print(f"  Found {len(ads_data)} listings on page {page_index}")
+
+                    page_new_count = 0
+                    for car, signature in page_cars:
+                        # Avoid duplicates (same URL, or the same described ad reposted under a new URL)
+                        if car.url in seen_urls or (signature is not None and signature in seen_signatures):
+                            continue
+                        seen_urls.add(car.url)
+                        if signature is not None:
+                            seen_signatures.add(signature)
                         collected_cars.append(car)
                         page_new_count += 1
                         if len(collected_cars) >= limit:
                             break
-            
-            print(f"  Added {page_new_count} new cars from page {page_index} (Total: {len(collected_cars)})")
-            
-            # Check if there are more pages
-            if page_index >= total_pages or not metadata.get("has_next", False):
-                print(f"  Reached last page ({total_pages})")
-                break
-            
-            page_index += 1
-            time.sleep(random.uniform(0.8, 1.5))  # Be respectful with API
-
-        except requests.RequestException as e:
-            print(f"Network error on page {page_index}: {e}")
-            break
-        except ValueError as e:
-            print(f"JSON parsing error on page {page_index}: {e}")
-            break
-        except Exception as e:
-            print(f"Exception on page {page_index}: {e}")
-            import traceback
-            traceback.print_exc()
-            break
+                
+                    print(f"  Added {page_new_count} new cars from page {page_index} (Total: {len(collected_cars)})")
+                
+                    # Don't prefetch more pages than the remaining cars could need
+                    remaining = limit - len(collected_cars)
+                    lookahead = max(1, min(PAGE_WINDOW, math.ceil(remaining / len(ads_data))))
+                
+                    # Check if there are more pages
+                    if page_index >= total_pages or not metadata.get("has_next", False):
+                        print(f"  Reached last page ({total_pages})")
+                        break
+                
+                    page_index += 1
+
+                except requests.HTTPError as e:
+                    print(f"Error fetching page {page_index}: {e.response.status_code}")
+                    break
+                except requests.RequestException as e:
+                    print(f"Network error on page {page_index}: {e}")
+                    break
+                except ValueError as e:
+                    print(f"JSON parsing error on page {page_index}: {e}")
+                    break
+                except Exception as e:
+                    print(f"Exception on page {page_index}: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    break
+        finally:
+            # Drop requests for pages we no longer need, also on Ctrl+C or any other exception;
+            # running ones see stop and skip the GET
+            stop.set()
+            for future in pending.values():
+                future.cancel()
 
     return collected_cars
 
@@ -270,21 +426,19 @@ def save_to_excel(cars: List[CarListing], path: Path):
             print(f"File locked, using alternative name: {path.name}")
     
     try:
-        workbook = xlsxwriter.Workbook(str(path))
+        # constant_memory flushes each row to disk as it's written (rows must go in order)
+        workbook = xlsxwriter.Workbook(str(path), {"constant_memory": True})
         worksheet = workbook.add_worksheet("Samand Listings")
 
+        header_fmt = workbook.add_format({"bold": True})
         headers = ["Price", "Mileage", "Color", "Production Year", "Transmission", "Description", "URL"]
-        for col, h in enumerate(headers):
-            worksheet.write(0, col, h)
+        worksheet.write_row(0, 0, headers, header_fmt)
 
         for row, car in enumerate(cars, start=1):
-            worksheet.write(row, 0, car.price)
-            worksheet.write(row, 1, car.mileage)
-            worksheet.write(row, 2, car.color)
-            worksheet.write(row, 3, car.production_year)
-            worksheet.write(row, 4, car.transmission)
-            worksheet.write(row, 5, car.description)
-            worksheet.write(row, 6, car.url)
+            worksheet.write_row(row, 0, (car.price, car.mileage, car.color))
+            # Year is always an int, so skip write()'s type sniffing
+            worksheet.write_number(row, 3, car.production_year)
+            worksheet.write_row(row, 4, (car.transmission, car.description, car.url))
 
         workbook.close()
         print(f"Saved {len(cars)} cars to {path.resolve()}")
@@ -299,10 +453,51 @@ def save_to_excel(cars: List[CarListing], path: Path):
         print(f"Error saving Excel file: {e}")
         raise
 
+def save_to_csv(cars: List[CarListing], path: Path):
+    """Save listings to a UTF-8 CSV file (with BOM so Excel shows Persian text correctly)."""
+    if not cars:
+        print("No listings to save!")
+        return
+    
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow([field.name for field in fields(CarListing)])
+        writer.writerows(astuple(car) for car in cars)
+    print(f"Saved {len(cars)} cars to {path.resolve()}")
+
+def save_to_parquet(cars: List[CarListing], path: Path):
+    """Save listings to a zstd-compressed Parquet file for programmatic consumers."""
+    if not cars:
+        print("No listings to save!")
+        return
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pylist([asdict(car) for car in cars])
+    pq.write_table(table, path, compression="zstd")
+    print(f"Saved {len(cars)} cars to {path.resolve()}")
+
 if __name__ == "__main__":
-    cars = scrape_bama(limit=TARGET_COUNT)
+    parser = argparse.ArgumentParser(description="Scrape Samand car listings from bama.ir")
+    parser.add_argument("--cache", action="store_true",
+                        help=f"Cache API responses in {CACHE_NAME}.sqlite so re-runs skip the network")
+    parser.add_argument("--format", choices=["xlsx", "parquet", "csv"], default="xlsx",
+                        help="Output format (xlsx for reading, parquet/csv for downstream analysis)")
+    args = parser.parse_args()
+
+    # Caller-owned session/executor: further scrape_bama calls here would reuse the same pool
+    with create_session(args.cache) as session, ThreadPoolExecutor(max_workers=PAGE_WINDOW) as executor:
+        cars = scrape_bama(limit=TARGET_COUNT, session=session, executor=executor)
     if cars:
-        save_to_excel(cars, OUTPUT_PATH)
+        if args.format == "parquet":
+            save_to_parquet(cars, OUTPUT_PATH.with_suffix(".parquet"))
+        elif args.format == "csv":
+            save_to_csv(cars, OUTPUT_PATH.with_suffix(".csv"))
+        else:
+            save_to_excel(cars, OUTPUT_PATH)
     else:
         print("No cars found matching criteria.")
 